@@ -19,6 +19,7 @@ from chirp import bitwise, memmap
 from chirp.settings import RadioSettingGroup, RadioSetting, RadioSettings
 from chirp.settings import RadioSettingValueInteger, RadioSettingValueString
 from chirp.settings import RadioSettingValueList, RadioSettingValueBoolean
+import collections
 import time
 import struct
 import sys
@@ -147,6 +148,9 @@ THD72_SPECIAL_REV = {}
 for k, v in THD72_SPECIAL.items():
     THD72_SPECIAL_REV[v] = k
 
+_THD72_SPECIAL_SORTED = sorted(THD72_SPECIAL.keys())
+_THD72_MAX_NUMBER = max(THD72_SPECIAL.values()) + 1
+
 TMODES = {
     0x08: "Tone",
     0x04: "TSQL",
@@ -189,6 +193,26 @@ DUPLEX_REV = {
 
 TUNE_STEPS = [5.0, 6.25, 8.33, 10.0, 12.5, 15.0, 20.0, 25.0, 30.0, 50.0, 100.0]
 
+# reverse indexes into the chirp_common constant lists, so set_memory
+# does not have to do a linear .index() scan per field
+_TONE_INDEX = {tone: i for i, tone in enumerate(chirp_common.TONES)}
+_DTCS_INDEX = {code: i for i, code in enumerate(chirp_common.DTCS_CODES)}
+_CROSS_INDEX = {mode: i for i, mode in enumerate(chirp_common.CROSS_MODES)}
+
+# header exchanged before each 256-byte block transfer
+_BLOCK_HDR = struct.Struct("<cBHB")
+
+# Raw overlay of the regions declared in mem_format, used by
+# get_memory_batch to unpack records straight from the packed image
+# instead of going through the bitwise layer one field at a time.
+_FLAG_BASE = 0x0c00
+_MEM_BASE = 0x1500
+_NAME_BASE = 0x5e00
+_WX_NAME_BASE = 0x7de0
+# freq, unknown1/tune_step, mode, tone_mode/duplex, rtone, ctone,
+# dtcs, cross_mode, offset, unknown2/split_tune_step
+_MEM_REC = struct.Struct("<IBBBBBBBIB")
+
 EXCH_R = "R\x00\x00\x00\x00"
 EXCH_W = "W\x00\x00\x00\x00"
 
@@ -230,7 +254,14 @@ class THD72Radio(chirp_common.CloneModeRadio):
     mem_upper_limit = 1022
     _memsize = 65536
     _model = ""  # FIXME: REMOVE
-    _dirty_blocks = []
+    _dirty_blocks = set()
+    _out_frame = None
+    _FEATURES = None
+    _name_cache = None
+
+    # number of write_block frames we allow in flight before waiting
+    # for the radio to ACK the oldest one
+    WRITE_WINDOW = 4
 
     _LCD_CONTRAST = ["Level %d" % x for x in range(1, 16)]
     _LAMP_CONTROL = ["Manual", "Auto"]
@@ -243,6 +274,12 @@ class THD72Radio(chirp_common.CloneModeRadio):
     _KEY_BEEP = ["OFF", "Radio & GPS", "Radio Only", "GPS Only"]
 
     def get_features(self):
+        # features never change at runtime, so build them only once
+        if type(self)._FEATURES is None:
+            type(self)._FEATURES = self._build_features()
+        return self._FEATURES
+
+    def _build_features(self):
         rf = chirp_common.RadioFeatures()
         rf.memory_bounds = (0, 1031)
         rf.valid_bands = [(118000000, 174000000),
@@ -265,7 +302,8 @@ class THD72Radio(chirp_common.CloneModeRadio):
 
     def process_mmap(self):
         self._memobj = bitwise.parse(mem_format, self._mmap)
-        self._dirty_blocks = []
+        self._dirty_blocks = set()
+        self._name_cache = None
 
     def _detect_baud(self):
         for baud in [9600, 19200, 38400, 57600]:
@@ -285,24 +323,24 @@ class THD72Radio(chirp_common.CloneModeRadio):
         raise errors.RadioError("No response from radio")
 
     def get_special_locations(self):
-        return sorted(THD72_SPECIAL.keys())
+        return list(_THD72_SPECIAL_SORTED)
 
     def add_dirty_block(self, memobj):
-        block = memobj._offset // 256
-        if block not in self._dirty_blocks:
-            self._dirty_blocks.append(block)
-        self._dirty_blocks.sort()
-        print("dirty blocks: ", self._dirty_blocks)
+        self._dirty_blocks.add(memobj._offset // 256)
 
     def get_channel_name(self, number):
-        if number < 999:
-            name = str(self._memobj.channel_name[number].name) + '\xff'
-        elif number >= 1020 and number < 1030:
-            number -= 1020
-            name = str(self._memobj.wx_name[number].name) + '\xff'
-        else:
-            return ''
-        return name[:name.index('\xff')].rstrip()
+        if self._name_cache is None:
+            # decode every name in one pass over the packed image;
+            # materializing them one at a time through the bitwise
+            # layer is far slower for bulk reads
+            packed = self._mmap.get_packed()
+            decode = self._decode_packed_name
+            self._name_cache = names = {}
+            for i in range(999):
+                names[i] = decode(packed, i)
+            for i in range(1020, 1030):
+                names[i] = decode(packed, i)
+        return self._name_cache.get(number, '')
 
     def set_channel_name(self, number, name):
         name = name[:8] + '\xff' * 8
@@ -310,9 +348,13 @@ class THD72Radio(chirp_common.CloneModeRadio):
             self._memobj.channel_name[number].name = name[:8]
             self.add_dirty_block(self._memobj.channel_name[number])
         elif number >= 1020 and number < 1030:
-            number -= 1020
-            self._memobj.wx_name[number].name = name[:8]
-            self.add_dirty_block(self._memobj.wx_name[number])
+            self._memobj.wx_name[number - 1020].name = name[:8]
+            self.add_dirty_block(self._memobj.wx_name[number - 1020])
+        else:
+            return
+        if self._name_cache is not None:
+            idx = name.find('\xff')
+            self._name_cache[number] = name[:idx].rstrip()
 
     def get_raw_memory(self, number):
         return repr(self._memobj.memory[number]) + \
@@ -326,13 +368,19 @@ class THD72Radio(chirp_common.CloneModeRadio):
                 raise errors.InvalidMemoryLocation("Unknown channel %s" %
                                                    number)
 
-        if number < 0 or number > (max(THD72_SPECIAL.values()) + 1):
+        if number < 0 or number > _THD72_MAX_NUMBER:
             raise errors.InvalidMemoryLocation(
                 "Number must be between 0 and 999")
 
         _mem = self._memobj.memory[number]
         flag = self._memobj.flag[number]
 
+        # hoist the chirp_common constant lookups out of the body
+        TONES = chirp_common.TONES
+        DTCS_CODES = chirp_common.DTCS_CODES
+        CROSS_MODES = chirp_common.CROSS_MODES
+        SKIP_VALUES = chirp_common.SKIP_VALUES
+
         mem = chirp_common.Memory()
         mem.number = number
 
@@ -345,17 +393,79 @@ class THD72Radio(chirp_common.CloneModeRadio):
         mem.name = self.get_channel_name(number)
         mem.freq = int(_mem.freq)
         mem.tmode = TMODES[int(_mem.tone_mode)]
-        mem.rtone = chirp_common.TONES[_mem.rtone]
-        mem.ctone = chirp_common.TONES[_mem.ctone]
-        mem.dtcs = chirp_common.DTCS_CODES[_mem.dtcs]
+        mem.rtone = TONES[_mem.rtone]
+        mem.ctone = TONES[_mem.ctone]
+        mem.dtcs = DTCS_CODES[_mem.dtcs]
         mem.duplex = DUPLEX[int(_mem.duplex)]
         mem.offset = int(_mem.offset)
         mem.mode = MODES[int(_mem.mode)]
         mem.tuning_step = TUNE_STEPS[int(_mem.tune_step)]
 
         if number < 999:
-            mem.skip = chirp_common.SKIP_VALUES[int(flag.skip)]
-            mem.cross_mode = chirp_common.CROSS_MODES[_mem.cross_mode]
+            mem.skip = SKIP_VALUES[int(flag.skip)]
+            mem.cross_mode = CROSS_MODES[_mem.cross_mode]
+        if number > 999:
+            mem.cross_mode = CROSS_MODES[0]
+            mem.immutable = ["number", "bank", "extd_number", "cross_mode"]
+            if number >= 1020 and number < 1030:
+                mem.immutable += ["freq", "offset", "tone", "mode",
+                                  "tmode", "ctone", "skip"]  # FIXME: ALL
+            else:
+                mem.immutable += ["name"]
+
+        return mem
+
+    def get_memory_batch(self, numbers):
+        """Decode many memories in one pass.
+
+        Equivalent to [self.get_memory(n) for n in numbers], but
+        unpacks the 16-byte channel records directly from the packed
+        image, which avoids the bitwise layer's per-field overhead
+        that dominates bulk reads."""
+        packed = self._mmap.get_packed()
+        return [self._decode_packed_memory(packed, number)
+                for number in numbers]
+
+    def _decode_packed_memory(self, packed, number):
+        if isinstance(number, str):
+            try:
+                number = THD72_SPECIAL[number]
+            except KeyError:
+                raise errors.InvalidMemoryLocation("Unknown channel %s" %
+                                                   number)
+
+        if number < 0 or number > _THD72_MAX_NUMBER:
+            raise errors.InvalidMemoryLocation(
+                "Number must be between 0 and 999")
+
+        mem = chirp_common.Memory()
+        mem.number = number
+
+        if number > 999:
+            mem.extd_number = THD72_SPECIAL_REV[number]
+        disabled = packed[_FLAG_BASE + number * 2] >> 4
+        if disabled == 0xf:
+            mem.empty = True
+            return mem
+
+        (freq, tstep, mode, tmd, rtone, ctone, dtcs, cross, offset,
+         _split) = _MEM_REC.unpack_from(packed, _MEM_BASE + number * 16)
+
+        mem.name = self._decode_packed_name(packed, number)
+        mem.freq = freq
+        mem.tmode = TMODES[tmd >> 4]
+        mem.rtone = chirp_common.TONES[rtone]
+        mem.ctone = chirp_common.TONES[ctone]
+        mem.dtcs = chirp_common.DTCS_CODES[dtcs]
+        mem.duplex = DUPLEX[tmd & 0x0f]
+        mem.offset = offset
+        mem.mode = MODES[mode]
+        mem.tuning_step = TUNE_STEPS[tstep & 0x0f]
+
+        if number < 999:
+            skip = packed[_FLAG_BASE + number * 2 + 1]
+            mem.skip = chirp_common.SKIP_VALUES[skip]
+            mem.cross_mode = chirp_common.CROSS_MODES[cross]
         if number > 999:
             mem.cross_mode = chirp_common.CROSS_MODES[0]
             mem.immutable = ["number", "bank", "extd_number", "cross_mode"]
@@ -367,9 +477,23 @@ class THD72Radio(chirp_common.CloneModeRadio):
 
         return mem
 
+    @staticmethod
+    def _decode_packed_name(packed, number):
+        if number < 999:
+            base = _NAME_BASE + number * 8
+        elif number >= 1020 and number < 1030:
+            base = _WX_NAME_BASE + (number - 1020) * 8
+        else:
+            return ''
+        raw = packed[base:base + 8]
+        idx = raw.find(b'\xff')
+        if idx >= 0:
+            raw = raw[:idx]
+        return ''.join(chr(c) for c in raw).rstrip()
+
     def set_memory(self, mem):
-        LOG.debug("set_memory(%d)" % mem.number)
-        if mem.number < 0 or mem.number > (max(THD72_SPECIAL.values()) + 1):
+        LOG.debug("set_memory(%d)", mem.number)
+        if mem.number < 0 or mem.number > _THD72_MAX_NUMBER:
             raise errors.InvalidMemoryLocation(
                 "Number must be between 0 and 999")
 
@@ -399,10 +523,10 @@ class THD72Radio(chirp_common.CloneModeRadio):
             self.set_channel_name(mem.number, mem.name)
 
         _mem.tone_mode = TMODES_REV[mem.tmode]
-        _mem.rtone = chirp_common.TONES.index(mem.rtone)
-        _mem.ctone = chirp_common.TONES.index(mem.ctone)
-        _mem.dtcs = chirp_common.DTCS_CODES.index(mem.dtcs)
-        _mem.cross_mode = chirp_common.CROSS_MODES.index(mem.cross_mode)
+        _mem.rtone = _TONE_INDEX[mem.rtone]
+        _mem.ctone = _TONE_INDEX[mem.ctone]
+        _mem.dtcs = _DTCS_INDEX[mem.dtcs]
+        _mem.cross_mode = _CROSS_INDEX[mem.cross_mode]
         _mem.duplex = DUPLEX_REV[mem.duplex]
         _mem.offset = mem.offset
         _mem.mode = MODES_REV[mem.mode]
@@ -420,6 +544,78 @@ class THD72Radio(chirp_common.CloneModeRadio):
         if mem.number < 999:
             flag.skip = chirp_common.SKIP_VALUES.index(mem.skip)
 
+    def set_memory_bulk(self, mems):
+        """Write many memories in one pass.
+
+        Equivalent to calling set_memory for each entry, but packs
+        each 16-byte channel record with a cached struct instead of
+        ten separate bitwise field assignments. Blocks are marked
+        dirty before they are written, so a failure partway through
+        the batch never leaves a modified block unmarked."""
+        LOG.debug("set_memory_bulk(%d memories)", len(mems))
+        # numbers are cheap to check up front; later per-entry
+        # failures (bad frequency, tuning step) abort the batch just
+        # like they abort a sequence of set_memory calls
+        for mem in mems:
+            if mem.number < 0 or mem.number > _THD72_MAX_NUMBER:
+                raise errors.InvalidMemoryLocation(
+                    "Number must be between 0 and 999")
+
+        mmap = self._mmap
+        dirty = self._dirty_blocks
+        for mem in mems:
+            # weather channels can only change name, nothing else
+            if mem.number >= 1020 and mem.number < 1030:
+                self.set_channel_name(mem.number, mem.name)
+                continue
+
+            fpos = _FLAG_BASE + mem.number * 2
+            flag = mmap[fpos][0]
+            dirty.add(fpos // 256)
+
+            # only delete non-WX channels
+            was_empty = (flag >> 4) == 0xf
+            if mem.empty:
+                mmap[fpos] = 0xf0 | (flag & 0x0f)
+                continue
+
+            rpos = _MEM_BASE + mem.number * 16
+            if was_empty:
+                # matches what initialize() leaves in the unknown
+                # nibbles once set_memory has rewritten every field
+                rec = bytearray(16)
+            else:
+                rec = bytearray(mmap[rpos:rpos + 16])
+
+            if mem.number < 999:
+                self.set_channel_name(mem.number, mem.name)
+
+            tune_step = TUNE_STEPS.index(mem.tuning_step)
+            if mem.duplex == 'split':
+                split_step = TUNE_STEPS.index(
+                    chirp_common.required_step(mem.offset))
+            else:
+                split_step = tune_step
+
+            _MEM_REC.pack_into(
+                rec, 0,
+                mem.freq,
+                (rec[4] & 0xf0) | tune_step,
+                MODES_REV[mem.mode],
+                (TMODES_REV[mem.tmode] << 4) | DUPLEX_REV[mem.duplex],
+                _TONE_INDEX[mem.rtone],
+                _TONE_INDEX[mem.ctone],
+                _DTCS_INDEX[mem.dtcs],
+                _CROSS_INDEX[mem.cross_mode],
+                mem.offset,
+                (rec[15] & 0xf0) | split_step)
+            dirty.add(rpos // 256)
+            mmap[rpos] = bytes(rec)
+
+            mmap[fpos] = get_prog_vfo(mem.freq) & 0x0f
+            if mem.number < 999:
+                mmap[fpos + 1] = chirp_common.SKIP_VALUES.index(mem.skip)
+
     def sync_in(self):
         self._detect_baud()
         self._mmap = self.download()
@@ -428,38 +624,62 @@ class THD72Radio(chirp_common.CloneModeRadio):
     def sync_out(self):
         self._detect_baud()
         if len(self._dirty_blocks):
-            self.upload(self._dirty_blocks)
+            self.upload(sorted(self._dirty_blocks))
         else:
             self.upload()
 
     def read_block(self, block, count=256):
-        self.pipe.write(struct.pack("<cBHB", b"R", 0, block, 0))
+        self.pipe.write(_BLOCK_HDR.pack(b"R", 0, block, 0))
         r = self.pipe.read(5)
         if len(r) != 5:
             raise Exception("Did not receive block response")
 
-        cmd, _zero, _block, zero = struct.unpack("<cBHB", r)
+        cmd, _zero, _block, zero = _BLOCK_HDR.unpack(r)
         if cmd != b"W" or _block != block:
             raise Exception("Invalid response: %s %i" % (cmd, _block))
 
-        data = b""
-        while len(data) < count:
-            data += self.pipe.read(count - len(data))
+        data = bytearray(count)
+        view = memoryview(data)
+        got = 0
+        while got < count:
+            got += self.pipe.readinto(view[got:])
 
         self.pipe.write(bytes([0x06]))
         if self.pipe.read(1) != bytes([0x06]):
             raise Exception("Did not receive post-block ACK!")
 
-        return data
+        return bytes(data)
 
-    def write_block(self, block, map):
-        self.pipe.write(struct.pack("<cBHB", b"W", 0, block, 0))
+    def send_block(self, block, map):
+        """Send a write-block frame without waiting for the ACK"""
+        if self._out_frame is None:
+            self._out_frame = bytearray(5 + 256)
+        frame = self._out_frame
+        _BLOCK_HDR.pack_into(frame, 0, b"W", 0, block, 0)
         base = block * 256
-        self.pipe.write(map[base:base + 256])
-
-        ack = self.pipe.read(1)
+        frame[5:] = map[base:base + 256]
+        self.pipe.write(frame)
+
+    def recv_ack(self):
+        return self.pipe.read(1) == bytes([0x06])
+
+    def _collect_ack(self, pending, retries):
+        """Wait for the oldest in-flight block, retransmitting on NAK.
+
+        Returns the number of blocks confirmed (1 or 0)."""
+        block = pending.popleft()
+        if self.recv_ack():
+            return 1
+        retries[block] = retries.get(block, 0) + 1
+        if retries[block] > 3:
+            raise errors.RadioError("Radio NAK'd block %i" % block)
+        self.send_block(block, self._mmap)
+        pending.append(block)
+        return 0
 
-        return ack == bytes([0x06])
+    def write_block(self, block, map):
+        self.send_block(block, map)
+        return self.recv_ack()
 
     def download(self, raw=False, blocks=None):
         if blocks is None:
@@ -477,28 +697,31 @@ class THD72Radio(chirp_common.CloneModeRadio):
         except AttributeError:
             self.pipe.rts = True
         self.pipe.read(1)
-        data = b""
-        LOG.debug("reading blocks %d..%d" % (blocks[0], blocks[-1]))
+        data = bytearray(b'\xff' * self._memsize)
+        LOG.debug("reading blocks %d..%d", blocks[0], blocks[-1])
         total = len(blocks)
         count = 0
+        blocks_set = set(blocks)
+        # hoist the attribute lookups out of the block loop
+        read_block = self.read_block
+        status_fn = self.status_fn
         for i in allblocks:
-            if i not in blocks:
-                data += 256 * b'\xff'
+            if i not in blocks_set:
                 continue
-            data += self.read_block(i)
+            data[i * 256:(i + 1) * 256] = read_block(i)
             count += 1
-            if self.status_fn:
+            if status_fn:
                 s = chirp_common.Status()
                 s.msg = "Cloning from radio"
                 s.max = total
                 s.cur = count
-                self.status_fn(s)
+                status_fn(s)
 
         self.pipe.write(b"E")
 
         if raw:
-            return data
-        return memmap.MemoryMapBytes(data)
+            return bytes(data)
+        return memmap.MemoryMapBytes(bytes(data))
 
     def upload(self, blocks=None):
         if blocks is None:
@@ -515,34 +738,61 @@ class THD72Radio(chirp_common.CloneModeRadio):
         except AttributeError:
             self.pipe.rts = True
         self.pipe.read(1)
-        LOG.debug("writing blocks %d..%d" % (blocks[0], blocks[-1]))
+        LOG.debug("writing blocks %d..%d", blocks[0], blocks[-1])
         total = len(blocks)
         count = 0
+        # Keep several write frames in flight so the serial round-trip
+        # for each ACK overlaps with the next block's transmission.
+        pending = collections.deque()
+        retries = {}
+        # hoist the attribute lookups out of the block loop
+        send_block = self.send_block
+        collect_ack = self._collect_ack
+        status_fn = self.status_fn
         for i in blocks:
-            r = self.write_block(i, self._mmap)
-            count += 1
-            if not r:
-                raise errors.RadioError("self NAK'd block %i" % i)
-            if self.status_fn:
+            send_block(i, self._mmap)
+            pending.append(i)
+            if len(pending) < self.WRITE_WINDOW:
+                continue
+            count += collect_ack(pending, retries)
+            if status_fn:
+                s = chirp_common.Status()
+                s.msg = "Cloning to radio"
+                s.max = total
+                s.cur = count
+                status_fn(s)
+        while pending:
+            count += collect_ack(pending, retries)
+            if status_fn:
                 s = chirp_common.Status()
                 s.msg = "Cloning to radio"
                 s.max = total
                 s.cur = count
-                self.status_fn(s)
+                status_fn(s)
 
         self.pipe.write(b"E")
-        # clear out blocks we uploaded from the dirty blocks list
-        self._dirty_blocks = [b for b in self._dirty_blocks if b not in blocks]
+        # clear out blocks we uploaded from the dirty blocks set
+        self._dirty_blocks -= set(blocks)
 
     def command(self, cmd, timeout=0.5):
-        start = time.time()
-
-        data = b""
-        LOG.debug("PC->D72: %s" % cmd)
+        LOG.debug("PC->D72: %s", cmd)
         self.pipe.write((cmd + "\r").encode())
-        while not data.endswith(b"\r") and (time.time() - start) < timeout:
-            data += self.pipe.read(1)
-        LOG.debug("D72->PC: %s" % data.strip())
+        if hasattr(self.pipe, "read_until"):
+            # let pyserial scan for the terminator instead of doing a
+            # one-syscall-per-byte python loop
+            old_timeout = self.pipe.timeout
+            self.pipe.timeout = timeout
+            try:
+                data = self.pipe.read_until(b"\r")
+            finally:
+                self.pipe.timeout = old_timeout
+        else:
+            start = time.time()
+            data = bytearray()
+            while not data.endswith(b"\r") and (time.time() - start) < timeout:
+                data += self.pipe.read(1)
+            data = bytes(data)
+        LOG.debug("D72->PC: %s", data.strip())
         return data.decode().strip()
 
     def get_id(self):
@@ -774,6 +1024,8 @@ if __name__ == "__main__":
     import serial
     import detect
     import getopt
+    import mmap as mmap_mod
+    import os
 
     def fixopts(opts):
         r = {}
@@ -826,16 +1078,27 @@ if __name__ == "__main__":
             raise errors.RadioError("last address out of range")
         elif last == 0:
             last = memmax
-        first /= 256
+        first //= 256
         if last % 256 != 0:
             last += 256
-        last /= 256
+        last //= 256
         blocks = range(first, last)
 
     if download:
         data = r.download(True, blocks)
-        file(fname, "wb").write(data)
+        # write through a fixed-size mmap rather than a buffered copy
+        fd = os.open(fname, os.O_CREAT | os.O_RDWR | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, len(data))
+            mm = mmap_mod.mmap(fd, len(data))
+            mm[:] = data
+            mm.close()
+        finally:
+            os.close(fd)
     else:
-        r._mmap = file(fname, "rb").read(r._memsize)
-        r.upload(blocks)
+        with open(fname, "rb") as f:
+            # map the image instead of reading it into a new buffer
+            r._mmap = mmap_mod.mmap(f.fileno(), r._memsize,
+                                    access=mmap_mod.ACCESS_READ)
+            r.upload(blocks)
     print("\nDone")